@@ -18,7 +18,7 @@ from collections import namedtuple
 import numpy as np
 
 from knover.data.dialog_reader import DialogReader
-from knover.utils import mask, pad_batch_data, str2bool
+from knover.utils import mask, pad_batch_data_nb, str2bool, to_optimized_size
 
 
 class NSPReader(DialogReader):
@@ -30,8 +30,15 @@ class NSPReader(DialogReader):
         group = DialogReader.add_cmdline_args(parser)
         group.add_argument("--mix_negative_sample", type=str2bool, default=False,
                            help="Whether to mix random negative samples into dataset.")
-        group.add_argument("--neg_pool_size", type=int, default=2 ** 16,
-                           help="The size of random negative pool.")
+        group.add_argument("--neg_pool_size", type=int, default=2 ** 12,
+                           help="The size of the sliding window which random negative samples are drawn from. "
+                           "If it is not positive, the window keeps all previous records.")
+        group.add_argument("--mix_in_batch", type=str2bool, default=False,
+                           help="Whether to generate random negative samples from the samples in the same batch "
+                           "instead of the random negative pool. It only works when `mix_negative_sample` is true. "
+                           "Each batch is doubled by its negative samples, so `batch_size` is halved when batching "
+                           "records. If `in_tokens` is true, the length of each record is also bounded by the longest "
+                           "context plus the longest response in the batch, which bounds the negative samples too.")
         return group
 
     def __init__(self, args):
@@ -41,66 +48,99 @@ class NSPReader(DialogReader):
 
         self.mix_negative_sample = args.mix_negative_sample
         self.neg_pool_size = args.neg_pool_size
+        self.mix_in_batch = args.mix_in_batch
+        if self.mix_negative_sample and self.mix_in_batch:
+            # each batch will be doubled by in-batch negative samples
+            self.batch_size = max(self.batch_size // 2, 1)
+        # draw random negative samples with numpy's Generator
+        self._np_rng = np.random.default_rng(args.random_seed)
         return
 
+    def sort_key(self, record):
+        """The key of record.
+
+        When mixing negative samples in batch with `in_tokens`, a negative sample concatenates the context of one
+        record and the response of another. Return the length of context and response separately, so the batch
+        budget is computed from the longest context plus the longest response.
+        """
+        if self.mix_negative_sample and self.mix_in_batch and self.in_tokens:
+            return [record.tgt_start_idx, len(record.token_ids) - record.tgt_start_idx]
+        return super(NSPReader, self).sort_key(record)
+
+    def _update_max_lens(self, max_lens, record):
+        """Update max_lens."""
+        max_lens = super(NSPReader, self)._update_max_lens(max_lens, record)
+        if self.mix_negative_sample and self.mix_in_batch and self.in_tokens:
+            # round the padded length up, it is what the padded batch actually takes
+            max_ctx_len, max_tgt_len = max_lens
+            max_lens = [max_ctx_len, to_optimized_size(max_ctx_len + max_tgt_len) - max_ctx_len]
+        return max_lens
+
+    def _to_array_record(self, record, **field_values):
+        """Store the sequence fields of record as int32 arrays.
+
+        Then mixing negative samples and padding work on numpy arrays.
+        """
+        for name in self.fields[:self.num_numerical_fields]:
+            field_values[name] = np.asarray(getattr(record, name), dtype="int32")
+        return record._replace(**field_values)
+
     def _convert_example_to_record(self, example, is_infer):
         """Convert example to record which can be used as the model's input."""
         record = super(NSPReader, self)._convert_example_to_record(example, False)
+        field_values = {}
         if "label" in example._fields:
-            record = record._replace(label=int(example.label))
-        return record
-
-    def _mix_negative_sample(self, reader, neg_pool_size=2 ** 16):
-        """Mix random negative samples into dataset."""
-        def _gen_from_pool(pool):
-            """Generate negative samples from pool."""
-            num_samples = len(pool)
-            if num_samples == 1:
-                # it is impossible to generate negative sample when the pool has only one sample
-                yield pool[0]._replace(label=1)
-                return
-            self.global_rng.shuffle(pool)
-            for i in range(num_samples):
-                pool[i] = pool[i]._replace(label=1)
-                j = (i + 1) % num_samples
-                idx_i = pool[i].tgt_start_idx
-                idx_j = pool[j].tgt_start_idx
-                field_values = {}
-                field_values["token_ids"] = pool[i].token_ids[:idx_i] + pool[j].token_ids[idx_j:]
-                field_values["type_ids"] = pool[i].type_ids[:idx_i] + pool[j].type_ids[idx_j:]
-                if self.position_style == "continuous":
-                    field_values["pos_ids"] = list(range(len(field_values["token_ids"])))
-                else:
-                    field_values["pos_ids"] = pool[i].pos_ids[:idx_i] + pool[j].pos_ids[idx_j:]
-                if self.use_role:
-                    field_values["role_ids"] = pool[i].role_ids[:idx_i] + pool[j].role_ids[idx_j:]
-                neg_record = self.Record(
-                    **field_values,
-                    tgt_start_idx=idx_i,
-                    data_id=-1,
-                    label=0
-                )
-                pool.append(neg_record)
-            self.global_rng.shuffle(pool)
-            for record in pool:
-                yield record
+            field_values["label"] = int(example.label)
+        return self._to_array_record(record, **field_values)
+
+    def _read_numerical_file(self, fp, phase, is_infer, delimiter=";"):
+        """Read a file which contains numerical data and yield records."""
+        for record in super(NSPReader, self)._read_numerical_file(fp, phase, is_infer, delimiter):
+            yield self._to_array_record(record)
+
+    def _mix_negative_sample(self, reader, neg_pool_size=2 ** 12):
+        """Mix random negative samples into dataset.
+
+        Keep a sliding window of the latest `neg_pool_size` records. Each record is yielded as a positive sample,
+        and then followed by a negative sample which concatenates its context and the response of a random record
+        in the window. If `neg_pool_size` is not positive, the window keeps all previous records.
+        """
+        seq_fields = self.fields[:self.num_numerical_fields]
 
         def __wrapper__():
-            pool = []
+            window = []
+            # the index of the oldest record in the window once the window is full
+            cursor = 0
             for record in reader():
-                pool.append(record)
-                if len(pool) == neg_pool_size:
-                    for record in _gen_from_pool(pool):
-                        yield record
-                    pool = []
-            if len(pool) > 0:
-                for record in _gen_from_pool(pool):
-                    yield record
+                yield record._replace(label=1)
+                if len(window) > 0:
+                    # it is impossible to generate negative sample for the first record
+                    neg_record = window[self._np_rng.integers(len(window))]
+                    idx_i = record.tgt_start_idx
+                    idx_j = neg_record.tgt_start_idx
+                    field_values = {}
+                    for name in seq_fields:
+                        field_values[name] = np.concatenate(
+                            [getattr(record, name)[:idx_i], getattr(neg_record, name)[idx_j:]])
+                    if self.position_style == "continuous":
+                        field_values["pos_ids"] = np.arange(len(field_values["token_ids"]), dtype="int32")
+                    yield self.Record(
+                        **field_values,
+                        tgt_start_idx=idx_i,
+                        data_id=-1,
+                        label=0
+                    )
+
+                if neg_pool_size <= 0 or len(window) < neg_pool_size:
+                    window.append(record)
+                else:
+                    window[cursor] = record
+                    cursor = (cursor + 1) % neg_pool_size
         return __wrapper__
 
     def _batch_reader(self, reader, phase=None, is_infer=False):
         """Construct a batch reader from a record reader."""
-        if self.mix_negative_sample:
+        if self.mix_negative_sample and not self.mix_in_batch:
             reader = self._mix_negative_sample(reader, self.neg_pool_size)
         return super(NSPReader, self)._batch_reader(
             reader,
@@ -110,15 +150,42 @@ class NSPReader(DialogReader):
     def _pad_batch_records(self, batch_records, is_infer, phase=None):
         """Padding a batch of records and construct model's inputs."""
         batch = {}
-        batch_token_ids = [record.token_ids for record in batch_records]
-        batch_type_ids = [record.type_ids for record in batch_records]
-        batch_pos_ids = [record.pos_ids for record in batch_records]
+        # transpose records into columns in a single pass, each field of `batch_fields` is a list
+        batch_fields = self.Record(*map(list, zip(*batch_records)))
+        batch_token_ids = batch_fields.token_ids
+        batch_type_ids = batch_fields.type_ids
+        batch_pos_ids = batch_fields.pos_ids
         if self.use_role:
-            batch_role_ids = [record.role_ids for record in batch_records]
-        batch_tgt_start_idx = [record.tgt_start_idx for record in batch_records]
-        batch_label = [record.label for record in batch_records]
-
-        batch_mask_token_ids, tgt_label, tgt_idx, label_idx = mask(
+            batch_role_ids = batch_fields.role_ids
+        batch_tgt_start_idx = batch_fields.tgt_start_idx
+        batch_label = batch_fields.label
+        batch_data_id = batch_fields.data_id
+
+        if self.mix_negative_sample and self.mix_in_batch:
+            # use the batch itself as the random negative pool: the i-th negative sample concatenates the
+            # context of the i-th sample and the response of the (i + 1)-th sample
+            batch_size = len(batch_records)
+            batch_label = [1] * batch_size
+            if batch_size > 1:
+                for i in range(batch_size):
+                    j = (i + 1) % batch_size
+                    idx_i = batch_tgt_start_idx[i]
+                    idx_j = batch_tgt_start_idx[j]
+                    batch_token_ids.append(np.concatenate([batch_token_ids[i][:idx_i], batch_token_ids[j][idx_j:]]))
+                    batch_type_ids.append(np.concatenate([batch_type_ids[i][:idx_i], batch_type_ids[j][idx_j:]]))
+                    if self.position_style == "continuous":
+                        batch_pos_ids.append(np.arange(len(batch_token_ids[-1]), dtype="int32"))
+                    else:
+                        batch_pos_ids.append(np.concatenate([batch_pos_ids[i][:idx_i], batch_pos_ids[j][idx_j:]]))
+                    if self.use_role:
+                        batch_role_ids.append(
+                            np.concatenate([batch_role_ids[i][:idx_i], batch_role_ids[j][idx_j:]]))
+                    batch_tgt_start_idx.append(idx_i)
+                    batch_label.append(0)
+                    batch_data_id.append(-1)
+
+        # all sequence fields share the same lengths, so they share the offsets of CSR layout
+        (flat_mask_token_ids, offsets), tgt_label, tgt_idx, label_idx = mask(
             batch_tokens=batch_token_ids,
             vocab_size=self.vocab_size,
             bos_id=self.bos_id,
@@ -126,15 +193,23 @@ class NSPReader(DialogReader):
             mask_id=self.mask_id,
             tgt_starts=batch_tgt_start_idx,
             labels=batch_label,
-            is_unidirectional=False)
-        if not is_infer:
-            batch_token_ids = batch_mask_token_ids
-        batch["token_ids"] = pad_batch_data(batch_token_ids, pad_id=self.pad_id)
-        batch["type_ids"] = pad_batch_data(batch_type_ids, pad_id=0)
-        batch["pos_ids"] = pad_batch_data(batch_pos_ids, pad_id=0)
+            is_unidirectional=False,
+            flatten_output=True)
+        if is_infer:
+            flat_token_ids = np.concatenate(batch_token_ids)
+        else:
+            flat_token_ids = flat_mask_token_ids
+        lengths = offsets[1:] - offsets[:-1]
+        max_len = to_optimized_size(int(lengths.max()))
+        batch["token_ids"] = pad_batch_data_nb(flat_token_ids, offsets, pad_id=self.pad_id, max_len=max_len)
+        batch["type_ids"] = pad_batch_data_nb(np.concatenate(batch_type_ids), offsets, pad_id=0, max_len=max_len)
+        batch["pos_ids"] = pad_batch_data_nb(np.concatenate(batch_pos_ids), offsets, pad_id=0, max_len=max_len)
         if self.use_role:
-            batch["role_ids"] = pad_batch_data(batch_role_ids, pad_id=0)
-        attention_mask = self._gen_self_attn_mask(batch_token_ids, is_unidirectional=False)
+            batch["role_ids"] = pad_batch_data_nb(
+                np.concatenate(batch_role_ids), offsets, pad_id=0, max_len=max_len)
+        # bi-directional attention among the valid (non-padding) tokens
+        valid = (np.arange(max_len) < lengths[:, None]).astype("float32")
+        attention_mask = np.einsum("bi,bj->bij", valid, valid)
 
         batch["attention_mask"] = attention_mask
         batch["label_idx"] = label_idx
@@ -145,7 +220,6 @@ class NSPReader(DialogReader):
             batch["tgt_label"] = tgt_label
             batch["tgt_idx"] = tgt_idx
         else:
-            batch_data_id = [record.data_id for record in batch_records]
             batch["data_id"] = np.array(batch_data_id).astype("int64").reshape([-1, 1])
 
         return batch
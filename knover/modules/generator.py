@@ -56,6 +56,9 @@ class Generator(object):
         # top-p sampling
         group.add_argument("--topp", type=float, default=0.9,
                            help="The hyper-parameter in top-p sampling.")
+        group.add_argument("--topp_k_cap", type=int, default=256,
+                           help="Only consider the top X tokens in top-p sampling, which avoids sorting the whole "
+                           "vocabulary in each step. If it is not positive or `topp` > 0.99, sort the whole vocabulary.")
 
         # beam search
         group.add_argument("--beam_size", type=int, default=10,
@@ -93,6 +96,7 @@ class Generator(object):
 
         # top-p sampling
         self.topp = args.topp
+        self.topp_k_cap = args.topp_k_cap
 
         # beam search
         self.beam_size = args.beam_size
@@ -103,8 +107,109 @@ class Generator(object):
         self.ngram_blocking = args.ngram_blocking
         if self.ngram_blocking > 0:
             self.ngram_blocking_processor = ops.NGramBlockingProcessor(self.ngram_blocking, args.bos_id, self.eos_id)
+
+        # logits penalties, they are constant during decoding
+        self.eos_penalty = np.zeros(self.vocab_size, dtype="float32")
+        self.eos_penalty[self.eos_id] = -1e9
+
+        self.token_penalty = np.zeros(self.vocab_size, dtype="float32")
+        if self.ignore_unk:
+            self.token_penalty[self.unk_id] = -1e9
+        if self.mask_id is not None and self.mask_id >= 0:
+            self.token_penalty[self.mask_id] = -1e9
+        # token penalty and eos penalty are applied together before reaching `min_dec_len`
+        self.min_len_penalty = self.token_penalty + self.eos_penalty
+
+        # length penalty of each decoding length, decoding length never exceeds `max_dec_len`
+        self.lp_table = np.array(
+            [((5 + i) / 6) ** self.length_penalty for i in range(self.max_dec_len + 1)], dtype="float32")
+
+        # specialize each decoding step: `_step` generates candidates and `_select` selects sequences from them
+        if self.decoding_strategy == "beam_search":
+            self._step = self._step_beam_search
+            self._select = self._select_beam_search
+        elif self.decoding_strategy.startswith("sampling"):
+            self._step = self._step_sampling
+            self._select = self._select_sampled
+        elif self.decoding_strategy.startswith("topk_sampling"):
+            self._step = self._step_topk_sampling
+            self._select = self._select_sampled
+        elif self.decoding_strategy.startswith("topp_sampling"):
+            self._step = self._step_topp_sampling
+            self._select = self._select_sampled
+        else:
+            raise ValueError(self.decoding_strategy)
         return
 
+    def _step_beam_search(self, probs):
+        """Select `beam_size` candidates with the highest probabilities."""
+        return layers.topk(input=probs, k=self.beam_size)
+
+    def _gather_sampled(self, probs, sampling_ids):
+        """Return the probabilities and the indices of sampled candidates."""
+        topk_indices = layers.unsqueeze(sampling_ids, [1])
+        topk_scores = paddle.index_sample(probs, topk_indices)
+        return topk_scores, topk_indices
+
+    def _step_sampling(self, probs):
+        """Sample a candidate from the whole vocabulary."""
+        sampling_ids = ops.sampling_id(probs)
+        return self._gather_sampled(probs, sampling_ids)
+
+    def _step_topk_sampling(self, probs):
+        """Sample a candidate from the top-k tokens."""
+        sampling_ids = ops.topk_sampling_id(probs, self.topk)
+        return self._gather_sampled(probs, sampling_ids)
+
+    def _step_topp_sampling(self, probs):
+        """Sample a candidate from the smallest set of tokens whose cumulative probability exceeds top-p."""
+        if 0 < self.topp_k_cap < self.vocab_size and self.topp <= 0.99:
+            # the outputs of topk are sorted in descending order
+            sorted_probs, sorted_idx = layers.topk(probs, k=self.topp_k_cap)
+        else:
+            sorted_probs, sorted_idx = layers.argsort(probs, descending=True)
+        cum_sorted_probs = layers.cumsum(sorted_probs, axis=1, exclusive=True)
+        lt_cond = layers.cast(cum_sorted_probs < self.topp, probs.dtype)
+        candidate_probs = sorted_probs * lt_cond
+        sampling_ids = ops.sampling_id(candidate_probs / layers.reduce_sum(candidate_probs, dim=-1, keep_dim=True))
+        sampling_ids = paddle.index_sample(sorted_idx, layers.unsqueeze(sampling_ids, [1]))
+        sampling_ids = layers.squeeze(sampling_ids, [1])
+        return self._gather_sampled(probs, sampling_ids)
+
+    def _mask_scores(self, accu_scores, is_finished, finished_scores, small_prob_cond):
+        """Keep the scores of finished sequences and mask out the candidates with too small probabilities."""
+        accu_scores = paddle.where(layers.cast(is_finished, "bool"), finished_scores, accu_scores)
+        return paddle.where(small_prob_cond, paddle.full_like(accu_scores, -1e9), accu_scores)
+
+    def _select_beam_search(self, state, pre_ids, pre_scores, topk_indices, accu_scores, small_prob_cond):
+        """Select `beam_size` sequences from the candidates of all beams."""
+        # expand the float mask, `paddle.expand_as` rejects a bool input which requires gradient
+        is_finished = paddle.expand_as(state["is_finished"], accu_scores)
+        finished_scores = paddle.expand_as(pre_scores, accu_scores)
+        accu_scores = self._mask_scores(accu_scores, is_finished, finished_scores, small_prob_cond)
+        topk_indices = layers.lod_reset(topk_indices, pre_ids)
+        accu_scores = layers.lod_reset(accu_scores, pre_ids)
+        selected_ids, selected_scores, parent_idx = layers.beam_search(
+            pre_ids=pre_ids,
+            pre_scores=pre_scores,
+            ids=topk_indices,
+            scores=accu_scores,
+            beam_size=self.beam_size,
+            end_id=-1,
+            return_parent_idx=True)
+        layers.assign(parent_idx, state["parent_idx"])
+        return selected_ids, selected_scores, parent_idx
+
+    def _select_sampled(self, state, pre_ids, pre_scores, topk_indices, accu_scores, small_prob_cond):
+        """Select the sampled candidate of each sequence.
+
+        Each sequence has exactly one sampled candidate, `beam_search` with beam_size = 1 selects it as is.
+        """
+        accu_scores = self._mask_scores(accu_scores, state["is_finished"], pre_scores, small_prob_cond)
+        selected_ids = layers.lod_reset(topk_indices, pre_ids)
+        selected_scores = layers.lod_reset(accu_scores, pre_ids)
+        return selected_ids, selected_scores, None
+
     def inference(self, model, inputs, outputs):
         """
         Run inference.
@@ -121,22 +226,19 @@ class Generator(object):
         max_len = layers.fill_constant([1], "int64", self.max_dec_len, force_cpu=True)
         min_len = layers.fill_constant([1], "int64", self.min_dec_len, force_cpu=True)
         step_idx = layers.fill_constant([1], "int64", 0, force_cpu=True)
+        one = layers.fill_constant([1], "float32", 1.0)
 
         if self.decoding_strategy == "beam_search":
             beam_size = self.beam_size
         else:
             beam_size = 1
 
-        eos_penalty = np.zeros(self.vocab_size, dtype="float32")
-        eos_penalty[self.eos_id] = -1e9
-        eos_penalty = layers.assign(eos_penalty)
-
-        token_penalty = np.zeros(self.vocab_size, dtype="float32")
-        if self.ignore_unk:
-            token_penalty[self.unk_id] = -1e9
-        if self.mask_id is not None and self.mask_id >= 0:
-            token_penalty[self.mask_id] = -1e9
-        token_penalty = layers.assign(token_penalty)
+        # upload penalties once, outside the while loop
+        eos_penalty = layers.assign(self.eos_penalty)
+        token_penalty = layers.assign(self.token_penalty)
+        min_len_penalty = layers.assign(self.min_len_penalty)
+        if not self.length_average and self.length_penalty > 0:
+            lp_table = layers.assign(self.lp_table)
 
         state = model._initialize_state(inputs, step_idx)
         if self.decoding_strategy == "beam_search":
@@ -153,108 +255,55 @@ class Generator(object):
             dec_out, _ = model._generation_network(**model_input)
             logits = model._calc_logits(dec_out)
             if model.dtype == "float16":
+                # -1e9 penalties, log(1e-9) and accumulated scores are out of float16 range, so post-process
+                # logits in float32. Cast only once: softmax of float32 logits gives float32 probs.
                 logits = layers.cast(logits, "float32")
 
-            logits = layers.elementwise_add(logits, token_penalty, axis=1)
-
             if self.ngram_blocking > 0:
                 logits = self.ngram_blocking_processor.apply(logits, state["is_finished"])
 
-            # min dec length
+            # token penalty and min dec length
             min_len_cond = layers.less_than(x=step_idx, y=min_len)
-            def min_len_penalty():
-                """Plus minimum length penalty."""
-                return layers.elementwise_add(logits, eos_penalty, axis=1)
-            def no_penalty():
-                """No penalty."""
-                return logits
-            logits = layers.case([(min_len_cond, min_len_penalty)], default=no_penalty)
+            def add_min_len_penalty():
+                """Plus token penalty and minimum length penalty."""
+                return layers.elementwise_add(logits, min_len_penalty, axis=1)
+            def add_token_penalty():
+                """Plus token penalty."""
+                return layers.elementwise_add(logits, token_penalty, axis=1)
+            logits = layers.case([(min_len_cond, add_min_len_penalty)], default=add_token_penalty)
 
-            the_eos_penalty = state["is_finished"] * eos_penalty
-            logits = logits - the_eos_penalty
+            logits = logits - state["is_finished"] * eos_penalty
 
             # get probs
             probs = layers.softmax(logits / self.temperature)
-            if model.dtype == "float16":
-                probs = layers.cast(probs, "float32")
 
-            if self.decoding_strategy == "beam_search":
-                topk_scores, topk_indices = layers.topk(
-                    input=probs, k=beam_size)
-            else:
-                if self.decoding_strategy.startswith("sampling"):
-                    sampling_ids = ops.sampling_id(probs)
-                elif self.decoding_strategy.startswith("topk_sampling"):
-                    topk_probs, _ = layers.topk(input=probs, k=self.topk)
-                    ge_cond = layers.greater_equal(probs, topk_probs[:, -1:])
-                    ge_cond = layers.cast(ge_cond, probs.dtype)
-                    old_probs = probs
-                    probs = probs * ge_cond / layers.reduce_sum(topk_probs, dim=-1, keep_dim=True)
-                    sampling_ids = ops.sampling_id(probs)
-                    probs = old_probs
-                elif self.decoding_strategy.startswith("topp_sampling"):
-                    sorted_probs, sorted_idx = layers.argsort(probs, descending=True)
-                    cum_sorted_probs = layers.cumsum(sorted_probs, axis=1, exclusive=True)
-                    lhs = cum_sorted_probs
-                    rhs = layers.fill_constant_batch_size_like(
-                        cum_sorted_probs,
-                        cum_sorted_probs.shape,
-                        cum_sorted_probs.dtype,
-                        self.topp)
-                    lt_cond = layers.less_than(lhs, rhs)
-                    lt_cond = layers.cast(lt_cond, probs.dtype)
-                    old_probs = probs
-                    candidate_probs = sorted_probs * lt_cond
-                    probs = candidate_probs / layers.reduce_sum(candidate_probs, dim=-1, keep_dim=True)
-                    sampling_ids = ops.sampling_id(probs)
-                    sampling_ids = paddle.index_sample(sorted_idx, layers.unsqueeze(sampling_ids, [1]))
-                    sampling_ids = layers.squeeze(sampling_ids, [1])
-                    probs = old_probs
-                else:
-                    raise ValueError(self.decoding_strategy)
-
-                sampling_scores = layers.one_hot(layers.unsqueeze(sampling_ids, [1]), self.vocab_size)
-                sampling_scores = sampling_scores * probs - (1 - sampling_scores) * 1e3
-                topk_scores, topk_indices = layers.topk(sampling_scores, k=1)
-
-            pre_len = layers.cast(step_idx, "float32")
+            topk_scores, topk_indices = self._step(probs)
+
+            if self.length_average:
+                pre_len = layers.cast(step_idx, "float32")
+                cur_len = pre_len + 1
+            elif self.length_penalty > 0:
+                pre_lp = layers.gather(lp_table, step_idx)
             layers.increment(x=step_idx, value=1.0, in_place=True)
-            cur_len = layers.cast(step_idx, "float32")
+            if not self.length_average and self.length_penalty > 0:
+                cur_lp = layers.gather(lp_table, step_idx)
 
             # avoid nan in beam_search
-            small_prob_cond = layers.cast(topk_scores < 1e-9, topk_scores.dtype)
-            topk_scores = topk_scores * (1 - small_prob_cond) + 1e-9 * small_prob_cond
-            topk_scores = layers.log(topk_scores)
+            small_prob_cond = topk_scores < 1e-9
+            topk_scores = layers.log(paddle.clip(topk_scores, min=1e-9))
 
             # update scores
             if self.length_average:
                 accu_scores = layers.elementwise_add(
                     x=topk_scores, y=pre_scores * pre_len, axis=0) / cur_len
             elif self.length_penalty > 0:
-                pre_lp = layers.pow((5 + pre_len) / 6, self.length_penalty)
-                cur_lp = layers.pow((5 + cur_len) / 6, self.length_penalty)
                 accu_scores = layers.elementwise_add(
                     x=topk_scores, y=pre_scores * pre_lp, axis=0) / cur_lp
             else:
                 accu_scores = layers.elementwise_add(
                     x=topk_scores, y=pre_scores, axis=0)
-            x = layers.elementwise_mul(accu_scores, 1 - state["is_finished"], axis=0)
-            y = layers.elementwise_mul(pre_scores, state["is_finished"], axis=0)
-            accu_scores = layers.elementwise_add(x, y, axis=0)
-            accu_scores = accu_scores * (1 - small_prob_cond) - 1e9 * small_prob_cond
-            topk_indices = layers.lod_reset(topk_indices, pre_ids)
-            accu_scores = layers.lod_reset(accu_scores, pre_ids)
-            selected_ids, selected_scores, parent_idx = layers.beam_search(
-                pre_ids=pre_ids,
-                pre_scores=pre_scores,
-                ids=topk_indices,
-                scores=accu_scores,
-                beam_size=beam_size,
-                end_id=-1,
-                return_parent_idx=True)
-
-            if self.decoding_strategy == "beam_search":
-                layers.assign(parent_idx, state["parent_idx"])
+            selected_ids, selected_scores, parent_idx = self._select(
+                state, pre_ids, pre_scores, topk_indices, accu_scores, small_prob_cond)
             state = model._update_state(
                 state,
                 model_input,
@@ -263,13 +312,11 @@ class Generator(object):
                 step_idx)
 
             if self.ngram_blocking > 0:
-                if self.decoding_strategy == "beam_search":
-                    self.ngram_blocking_processor.update(selected_ids, state["is_finished"], parent_idx)
-                else:
-                    self.ngram_blocking_processor.update(selected_ids, state["is_finished"])
+                self.ngram_blocking_processor.update(selected_ids, state["is_finished"], parent_idx)
 
             length_cond = layers.less_than(x=step_idx, y=max_len)
-            finish_cond = layers.logical_not(layers.reduce_all(layers.cast(state["is_finished"], "bool")))
+            # `is_finished` is 0 / 1, so its minimum is less than 1 iff some sequences are not finished
+            finish_cond = layers.less_than(x=layers.reduce_min(state["is_finished"]), y=one)
             layers.logical_and(x=length_cond, y=finish_cond, out=cond)
 
         finished_ids, finished_scores = layers.beam_search_decode(
@@ -18,6 +18,7 @@ import copy
 
 import numpy as np
 import paddle
+from paddle.fluid.data_feeder import convert_dtype
 import paddle.static as static
 
 from knover.utils import rindex
@@ -62,6 +63,22 @@ def sampling_id(probs):
     return sampling_ids
 
 
+def topk_sampling_id(probs, k):
+    """Top-k sampling.
+
+    Mask the probabilities out of top-k, renormalize and sample in a single host op.
+    """
+    def __wrapper__(probs_list):
+        probs_list = np.array(probs_list)
+        kth_probs = np.partition(probs_list, -k, axis=-1)[:, -k, None]
+        return _sampling_id(probs_list * (probs_list >= kth_probs))
+
+    prog = static.default_main_program()
+    sampling_ids = prog.current_block().create_var(name="sampling_ids", dtype="int64", shape=[-1])
+    static.py_func(func=__wrapper__, x=probs, out=sampling_ids)
+    return sampling_ids
+
+
 class NGramBlockingProcessor(object):
     """N-gram blocking strategy."""
 
@@ -91,24 +108,34 @@ class NGramBlockingProcessor(object):
         static.py_func(func=__wrapper__, x=token_ids, out=None)
 
     def apply(self, logits, is_finished):
-        """Post process logits by N-gram blocking strategy."""
-        def __wrapper__(logits, is_finished):
-            logits = np.array(logits) # shape: [B, V]
+        """Post process logits by N-gram blocking strategy.
+
+        Only the blocked (row, token) positions are collected on host, and then they are penalized by a sparse
+        scatter on logits. It avoids copying the whole [B, V] logits between device and host in each step.
+        """
+        dtype = convert_dtype(logits.dtype)
+
+        def __wrapper__(is_finished):
             is_finished = np.array(is_finished) # shape: [B, 1]
-            for i in range(logits.shape[0]):
+            coords = []
+            for i in range(is_finished.shape[0]):
                 if is_finished[i]:
                     continue
                 if len(self.cur_ngram_list[i]) >= self.ngram - 1:
                     k = tuple(self.cur_ngram_list[i][-self.ngram + 1:])
                     if k in self.ngram_stat_list[i]:
-                        for v in self.ngram_stat_list[i][k]:
-                            logits[i][v] -= 1e9
-            return logits
+                        coords.extend([i, v] for v in self.ngram_stat_list[i][k])
+            updates = [-1e9] * len(coords)
+            if len(coords) == 0:
+                # scatter at least one position, add zero to it
+                coords, updates = [[0, 0]], [0]
+            return np.array(coords, dtype="int64"), np.array(updates, dtype=dtype)
 
         prog = static.default_main_program()
-        new_logits = prog.current_block().create_var(name="out_logits", dtype=logits.dtype, shape=logits.shape)
-        static.py_func(func=__wrapper__, x=(logits, is_finished), out=new_logits)
-        return new_logits
+        coords = prog.current_block().create_var(name="blocked_coords", dtype="int64", shape=[-1, 2])
+        updates = prog.current_block().create_var(name="blocked_updates", dtype=logits.dtype, shape=[-1])
+        static.py_func(func=__wrapper__, x=is_finished, out=[coords, updates])
+        return paddle.scatter_nd_add(logits, coords, updates)
 
     def update(self, pred, is_finished, parent_idx=None):
         """Update N-gram blocking strategy related data."""
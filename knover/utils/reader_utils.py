@@ -13,8 +13,6 @@
 # limitations under the License.
 """Reader utility."""
 
-import copy
-
 import numpy as np
 
 
@@ -35,13 +33,15 @@ def mask(batch_tokens,
          labels=None,
          is_unidirectional=False,
          use_latent=False,
-         use_bow=False):
+         use_bow=False,
+         flatten_output=False):
     """Add masking and return target's labels and indices.
 
     Add mask for batch_tokens, return out, mask_label, mask_idx;
     Note: mask_idx (masking index) corresponding to the indices of masking token in batch_tokens after padding.
+    If `flatten_output` is true, the bidirectional mask returns `out` as a tuple of flat tokens and offsets
+    (CSR layout): the i-th sequence is `tokens[offsets[i]:offsets[i + 1]]`.
     """
-    batch_tokens = copy.deepcopy(batch_tokens)
     max_len = max(map(len, batch_tokens))
     mask_label = []
     mask_idx = []
@@ -96,42 +96,31 @@ def mask(batch_tokens,
             return_list += [bow_label, bow_idx]
     else:
         # bidirectional mask language model
-        total_token_num = sum(map(len, batch_tokens))
+        lengths = np.array(list(map(len, batch_tokens)), dtype="int64")
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        tokens = np.concatenate(batch_tokens).astype("int64")
+        total_token_num = len(tokens)
         prob_mask = np.random.rand(total_token_num)
         # TODO: fix replace_ids, include [UNK]
         replace_ids = np.random.randint(3, high=vocab_size, size=total_token_num)
-        prob_index = 0
-        for sent_index, sent in enumerate(batch_tokens):
-            # add pair label position
-            if labels is not None:
-                label_idx.append([sent_index, 0])
-
-            # add mask label and position
-            for token_index, token in enumerate(sent):
-                if token == eos_id or token == bos_id:
-                    continue
-                prob = prob_mask[prob_index + token_index]
-                if prob > 0.15:
-                    continue
-                elif 0.03 < prob <= 0.15:
-                    # mask
-                    mask_label.append(sent[token_index])
-                    sent[token_index] = mask_id
-                    mask_idx.append([sent_index, token_index])
-                elif 0.015 < prob <= 0.03:
-                    # random replace
-                    mask_label.append(sent[token_index])
-                    sent[token_index] = replace_ids[prob_index + token_index]
-                    mask_idx.append([sent_index, token_index])
-                else:
-                    # keep the original token
-                    mask_label.append(sent[token_index])
-                    mask_idx.append([sent_index, token_index])
 
-            prob_index += len(sent)
+        # add pair label position
+        if labels is not None:
+            label_idx = [[sent_index, 0] for sent_index in range(len(batch_tokens))]
 
-        mask_label = np.array(mask_label).astype("int64").reshape([-1, 1])
-        mask_idx = np.array(mask_idx).astype("int64").reshape([-1, 2])
+        # add mask label and position
+        sent_index = np.repeat(np.arange(len(batch_tokens)), lengths)
+        token_index = np.arange(total_token_num) - np.repeat(offsets[:-1], lengths)
+        is_masked = (tokens != eos_id) & (tokens != bos_id) & (prob_mask <= 0.15)
+        mask_label = tokens[is_masked].reshape([-1, 1])
+        mask_idx = np.stack([sent_index, token_index], axis=1)[is_masked].reshape([-1, 2])
+        # mask: 0.03 < prob <= 0.15, random replace: 0.015 < prob <= 0.03, otherwise keep the original token
+        tokens = np.where(is_masked & (prob_mask > 0.03), mask_id, tokens)
+        tokens = np.where(is_masked & (prob_mask > 0.015) & (prob_mask <= 0.03), replace_ids, tokens)
+        if flatten_output:
+            batch_tokens = (tokens, offsets)
+        else:
+            batch_tokens = np.split(tokens, offsets[1:-1])
         return_list = [batch_tokens, mask_label, mask_idx]
 
     if labels is not None:
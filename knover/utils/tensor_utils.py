@@ -20,6 +20,13 @@ import paddle
 import paddle.fluid as fluid
 import paddle.fluid.core as core
 
+try:
+    from numba import njit, prange
+except ImportError:
+    print("You can install numba to speedup padding batch data.")
+    njit = None
+    prange = range
+
 
 try:
     if paddle.version.cuda() < "11.0" or paddle.version.cudnn() < "7.6.3":
@@ -84,6 +91,36 @@ def pad_batch_data(insts, pad_id=0):
     return inst_data.astype("int64").reshape([-1, max_len, 1])
 
 
+def _pad_flat_data(out, flat_data, offsets):
+    """Copy the i-th instance `flat_data[offsets[i]:offsets[i + 1]]` into `out[i]`."""
+    for i in prange(out.shape[0]):
+        start, end = offsets[i], offsets[i + 1]
+        out[i, :end - start] = flat_data[start:end]
+
+
+if njit is not None:
+    _pad_flat_data = njit(parallel=True, cache=True)(_pad_flat_data)
+
+
+def pad_batch_data_nb(flat_data, offsets, pad_id=0, max_len=None):
+    """Pad the instances stored in CSR layout to the max sequence length in batch.
+
+    The padding kernel is compiled by numba if it is available.
+
+    Args:
+        flat_data: A 1-D array which concatenates all instances.
+        offsets: A 1-D array of shape [batch_size + 1], the i-th instance is `flat_data[offsets[i]:offsets[i + 1]]`.
+        pad_id: The padding id.
+        max_len: The padded sequence length. If it is None, use the optimized size of the longest instance.
+    """
+    offsets = np.asarray(offsets, dtype="int64")
+    if max_len is None:
+        max_len = to_optimized_size(int(np.max(offsets[1:] - offsets[:-1])))
+    inst_data = np.full([len(offsets) - 1, max_len], pad_id, dtype="int64")
+    _pad_flat_data(inst_data, np.asarray(flat_data, dtype="int64"), offsets)
+    return inst_data.reshape([-1, max_len, 1])
+
+
 def convert_lodtensor_to_list(tensor):
     data = np.array(tensor)
     recursive_sequence_lengths = tensor.recursive_sequence_lengths()
@@ -38,6 +38,7 @@ if __name__ == "__main__":
         python_requires=">=3.7",
         install_requires=[
             "paddlepaddle-gpu>=2.0.0",
+            "numba",
             "numpy",
             "sentencepiece",
             "termcolor",